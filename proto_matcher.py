@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 
-import os, cmd, json, configparser, colorsys
+import os, cmd, json, mmap, pickle, hashlib, configparser, colorsys, functools
 from pathlib import Path
-from itertools import groupby
-from collections import defaultdict
+from itertools import groupby, repeat
+from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
 from typing import NamedTuple, Hashable, Iterable
 
 from rich.console import Console
@@ -13,10 +14,12 @@ from rich.text import Text
 from rich.style import Style
 from rich.color import Color
 
-from multiset import FrozenMultiset
+try:
+    import orjson # Optional, just makes writing the output files faster
+except ImportError:
+    orjson = None
 from google.protobuf.descriptor_pb2 import (
     FileDescriptorSet,
-    FileDescriptorProto,
     DescriptorProto,
     FieldDescriptorProto,
     EnumDescriptorProto
@@ -24,6 +27,49 @@ from google.protobuf.descriptor_pb2 import (
 
 CONFIG_FILE = Path("config.ini")
 OUTPUT_DIR = Path("output")
+SIGCACHE_VERSION = 3 # Bump whenever the pickled signature format changes
+
+class FrozenMultiset:
+    # Just the bits of multiset.FrozenMultiset that signatures need, but backed by a Counter
+    # and with the hash computed once (the multiset package rehashes all items on every call)
+    __slots__ = ("_counts", "_len", "_hash")
+
+    def __init__(self, elements: Iterable[Hashable] = ()):
+        self._counts = Counter(elements)
+        self._len = self._counts.total()
+        self._hash = hash(frozenset(self._counts.items()))
+
+    def __reduce__(self):
+        # Don't pickle the hash, str hashes are different for every run
+        return unpickle_multiset, (self._counts,)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other) -> bool:
+        if self is other:
+            return True
+        if type(other) != FrozenMultiset:
+            return NotImplemented
+        return self._hash == other._hash and self._counts == other._counts
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self):
+        return self._counts.elements()
+
+    def __getitem__(self, element: Hashable) -> int:
+        return self._counts[element]
+
+    def __repr__(self) -> str:
+        return f"FrozenMultiset({dict(self._counts)})"
+
+    def items(self):
+        return self._counts.items()
+
+    def distinct_elements(self):
+        return self._counts.keys()
 
 SignType = FrozenMultiset | frozenset | tuple | str
 
@@ -31,10 +77,16 @@ class FieldTuple(NamedTuple):
     label_type: str
     signature: SignType
 
+    def __reduce__(self):
+        return unpickle_field_tuple, tuple(self)
+
 class MapEntry(NamedTuple):
     key: SignType
     value: SignType
 
+    def __reduce__(self):
+        return unpickle_map_entry, tuple(self)
+
 Signature = SignType | FieldTuple | MapEntry
 
 console = Console()
@@ -65,10 +117,24 @@ config["ProtoMatcher"] = {
     "THRESHOLD": 0.5,
 
     "\n# If True, empty message types will be considered as bytes instead when generating signatures.": None,
-    "DEFAULT_EMPTY_TO_BYTES": True
+    "DEFAULT_EMPTY_TO_BYTES": True,
+
+    "\n# Number of processes used to generate signatures (0 for one per CPU, 1 to disable)": None,
+    "SIGNATURE_WORKERS": 1
 }
 options = config["ProtoMatcher"]
 
+# Parsed option values, since configparser re-parses them on every get (refreshed in load_config)
+def refresh_options():
+    global PACKAGE_NAME, MAX_SIG_DEPTH, MAX_DISPLAY_MATCHES, THRESHOLD, DEFAULT_EMPTY_TO_BYTES
+    PACKAGE_NAME = options["PACKAGE_NAME"]
+    MAX_SIG_DEPTH = options.getint("MAX_SIG_DEPTH", 0)
+    MAX_DISPLAY_MATCHES = options.getint("MAX_DISPLAY_MATCHES")
+    THRESHOLD = options.getfloat("THRESHOLD", 0.5)
+    DEFAULT_EMPTY_TO_BYTES = options.getboolean("DEFAULT_EMPTY_TO_BYTES", True)
+
+refresh_options()
+
 #region Utils
 def save_config():
     with open(CONFIG_FILE, "w") as f:
@@ -89,30 +155,108 @@ def load_config():
     if not options["OBS_PROTO_LIST"]:
         obs_list_path = input("Enter the path to the obfuscated proto list file:\n")
         change_option("OBS_PROTO_LIST", obs_list_path)
+    refresh_options()
 
 def get_descriptor_set(descriptor_path: str) -> FileDescriptorSet:
+    # Parse straight from a memory map of the file, instead of reading a full copy of it first
+    descriptor_set = FileDescriptorSet()
     with open(descriptor_path, "rb") as f:
-        return FileDescriptorSet.FromString(f.read())
+        if os.fstat(f.fileno()).st_size == 0:
+            return descriptor_set # Still a valid (empty) set, but empty files can't be mapped
+        with (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+              memoryview(mm) as view):
+            descriptor_set.ParseFromString(view)
+    return descriptor_set
     
 def get_proto_list(list_path: str) -> list[str]:
     with open(list_path) as f:
         return json.load(f)
 
+def save_json(obj, path: Path):
+    if orjson:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w") as f:
+            json.dump(obj, f, indent=2)
+
 def strip_proto_name(name: str) -> str:
-    return name.removeprefix(".").removeprefix(options["PACKAGE_NAME"]).removesuffix(".proto")
+    return name.removeprefix(".").removeprefix(PACKAGE_NAME).removesuffix(".proto")
 
 def is_obs_name(name: str) -> bool:
     return name.isalpha() and name.isupper()
 
+def cache_by_id(func):
+    # Signatures never change after generation, so their identity makes the cheapest cache key.
+    # The arguments are kept in the cache so their ids can't be recycled.
+    cache: dict[tuple[int, ...], tuple] = {}
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = tuple(map(id, args))
+        if key in cache:
+            return cache[key][1]
+        result = func(*args)
+        cache[key] = (args, result)
+        return result
+    return wrapper
+
+@cache_by_id
+def get_index_map(proto_list: list[str]) -> dict[str, int]:
+    # Same result as proto_list.index() (first occurrence), without the linear scan per lookup
+    index_map: dict[str, int] = {}
+    for i, name in enumerate(proto_list):
+        index_map.setdefault(name, i)
+    return index_map
+
+@cache_by_id
+def get_idx_weights(proto_list: list[str]) -> dict[str, float]:
+    # Ranking bonus for protos declared earlier in the list (up to +0.5)
+    return {name: (1 - ((i + 1) / len(proto_list))) * 0.5 for name, i in get_index_map(proto_list).items()}
+
+# Hash-consing for signatures: equal (sub)signatures share a single instance, which saves memory
+# and lets the identity-keyed caches hit for equal signatures from either descriptor set
+_interned_sigs: dict[Signature, Signature] = {}
+
+def intern_sig(signature: Signature) -> Signature:
+    return _interned_sigs.setdefault(signature, signature)
+
+# Unpickling (signature cache, worker results) interns bottom-up: children are already canonical
+# by the time their parent gets hashed, so interning the parent never needs a deep equality check
+def unpickle_multiset(counts: dict[Hashable, int]) -> FrozenMultiset:
+    return intern_sig(FrozenMultiset({intern_sig(element): count for element, count in counts.items()}))
+
+def unpickle_field_tuple(label_type: str, signature: SignType) -> FieldTuple:
+    return intern_sig(FieldTuple(intern_sig(label_type), intern_sig(signature)))
+
+def unpickle_map_entry(key: SignType, value: SignType) -> MapEntry:
+    return intern_sig(MapEntry(intern_sig(key), intern_sig(value)))
+
+def sig_items(signature: Signature) -> Iterable[tuple[Hashable, int]]:
+    # (element, multiplicity) pairs, enum values always count once
+    if type(signature) == FrozenMultiset:
+        return signature.items()
+    return ((i, 1) for i in signature)
+
+# Every distinct signature element (field, enum value, etc.) gets a small int id shared by both descriptor sets,
+# so scoring only has to hash each element once instead of on every comparison
+_element_ids: dict[Hashable, int] = {}
+
+@cache_by_id
+def get_sig_counts(signature: Signature) -> dict[int, int]:
+    return {_element_ids.setdefault(element, len(_element_ids)): count
+            for element, count in sig_items(signature)}
+
+@cache_by_id
 def get_sig_rlen(signature: Signature) -> int:
-    sig_type = type(signature)
-    if sig_type in (FrozenMultiset, tuple):
-        total_len = 0
-        for i in signature:
-            total_len += get_sig_rlen(i)
-        return total_len
-    elif sig_type == frozenset:
-        return len(signature)
+    match signature:
+        case FieldTuple(_, frozenset()): # An enum field is still just one field
+            return 1
+        case FieldTuple(_, field_sig):
+            return get_sig_rlen(field_sig)
+        case FrozenMultiset() | tuple():
+            return sum(map(get_sig_rlen, signature))
+        case frozenset():
+            return len(signature)
     return 1
 #endregion
 
@@ -120,13 +264,19 @@ def get_sig_rlen(signature: Signature) -> int:
 def to_proto_name(name: str) -> str:
     return f"[aquamarine3]{name}.proto[/]"
 
+@cache_by_id
+def short_hash_str(obj: Hashable) -> str:
+    return f"{abs(hash(obj)):X}"[:9]
+
 def short_hash(obj: Hashable) -> Text:
-    return Text(f"{abs(hash(obj)):X}"[:9], "dark_turquoise")
+    return Text(short_hash_str(obj), "dark_turquoise")
+
+# Red to green, precomputed since colored_percent gets called for every printed match
+PERCENT_GRADIENT = [Style(color=Color.from_rgb(*[i * 255 for i in
+                    colorsys.hsv_to_rgb(step / 255 * 0.3, 0.5, 1)])) for step in range(256)]
 
 def colored_percent(percent: float) -> Text:
-    gradient_rgb = [i * 255 for i in 
-    colorsys.hsv_to_rgb(percent * 0.3, 0.5, 1)]
-    style = Style(color=Color.from_rgb(*gradient_rgb))
+    style = PERCENT_GRADIENT[min(max(int(percent * 255), 0), 255)]
     return Text(f"{percent * 100:.3f}"[:5] + "%", style)
 
 def ints2ranges(iterable: Iterable) -> list[tuple]:
@@ -140,7 +290,7 @@ def ints2ranges(iterable: Iterable) -> list[tuple]:
 def print_sig_tree(signature: Signature):
     sig_type = "message" if type(signature) == FrozenMultiset else "enum"
     sig_tree = Tree(Text.assemble((sig_type, "blue"), " (", short_hash(signature), ")"))
-    max_depth = options.getint("MAX_SIG_DEPTH", 0)
+    max_depth = MAX_SIG_DEPTH
     sig_depth = 1
 
     def grow_sig_tree(sig: Signature, parent: Tree, depth=1):
@@ -148,30 +298,34 @@ def print_sig_tree(signature: Signature):
         sig_depth = max(sig_depth, depth)
             
         def unpack_field(field: str | FieldTuple, fsize: int = 0, add_info: str = ""):
-            fsize_txt = Text.assemble(": ", (str(sig[field]), "steel_blue1")) if fsize else ""
-            if type(field) == FieldTuple:
-                sig_hash = short_hash(field.signature)
-                is_message = field.label_type.endswith("message")
-                depth_txt = f"{depth} " if is_message else ""
-                branch = parent.add(Text.assemble(
-                    add_info, depth_txt, (field.label_type, "blue"), " (", sig_hash, ")", fsize_txt))
-                if max_depth > 0 and depth >= max_depth and is_message: return
-                grow_sig_tree(field.signature, branch, depth + int(is_message))
-            else:
-                parent.add(Text.assemble(add_info, (field, "blue"), fsize_txt))
-
-        if type(sig) in [FrozenMultiset, FieldTuple]:
-            fields = sig.distinct_elements() if type(sig) == FrozenMultiset else sig
-            for field in fields:
-                fsize = sig[field] if type(sig) == FrozenMultiset and sig[field] > 1 else 0
-                unpack_field(field, fsize)
-
-        elif type(sig) == MapEntry:
-            unpack_field(sig.key, add_info="key: ")
-            unpack_field(sig.value, add_info="value: ")
-
-        elif type(sig) == frozenset: # enum values
-            parent.add(Text(str(ints2ranges(sig)), "aquamarine3"))
+            fsize_txt = Text.assemble(": ", (str(fsize), "steel_blue1")) if fsize else ""
+            match field:
+                case FieldTuple(label_type, field_sig):
+                    is_message = label_type.endswith("message")
+                    depth_txt = f"{depth} " if is_message else ""
+                    branch = parent.add(Text.assemble(
+                        add_info, depth_txt, (label_type, "blue"), " (", short_hash(field_sig), ")", fsize_txt))
+                    if max_depth > 0 and depth >= max_depth and is_message: return
+                    grow_sig_tree(field_sig, branch, depth + int(is_message))
+                case _:
+                    parent.add(Text.assemble(add_info, (field, "blue"), fsize_txt))
+
+        # Class patterns are isinstance checks, so the NamedTuples have to come before plain tuples
+        match sig:
+            case FrozenMultiset():
+                for field, fsize in sig.items():
+                    unpack_field(field, fsize if fsize > 1 else 0)
+
+            case FieldTuple():
+                for field in sig:
+                    unpack_field(field)
+
+            case MapEntry(key, value):
+                unpack_field(key, add_info="key: ")
+                unpack_field(value, add_info="value: ")
+
+            case frozenset(): # enum values
+                parent.add(Text(str(ints2ranges(sig)), "aquamarine3"))
 
     grow_sig_tree(signature, sig_tree)
     print(sig_tree, f"Signature Tree Depth: {sig_depth}")
@@ -188,102 +342,139 @@ def sig_proto_table() -> Table:
     return table
 #endregion
 
+def get_len_ratio(sig1_len: int, sig2_len: int) -> float:
+    return min(sig1_len, sig2_len) / max(sig1_len, sig2_len)
+
+def score_intersection(intersection: int, sig1_len: int, sig2_len: int) -> float:
+    # Probably should make this a config option. Using the len ratio to affect the score means
+    # a new proto that could've been a match but has new fields will score less.
+    # Since intersection <= sig1_len, the len ratio is also an upper bound for the score.
+    return (intersection / sig1_len) * get_len_ratio(sig1_len, sig2_len)
+
+@cache_by_id
 def compare_sigs(sig1: Signature, sig2: Signature) -> float:
     # Possible TODO: just doing an intersection means that messages/enums/oneofs that-
     # don't have exactly matching signatures don't count towards the score.
     # Perhaps there can be a separate counter for these types? (only for scoring)
     # So even if the signature doesn't match, there's still a point for each message/enum/oneof
-    sig1_len = len(sig1)
-    sig2_len = len(sig2)
-    intersection = len(sig1 & sig2)
-    # Probably should make this a config option. Using the len ratio to affect the score means
-    # a new proto that could've been a match but has new fields will score less.
-    len_ratio = min(sig1_len, sig2_len) / max(sig1_len, sig2_len)
-    return (intersection / sig1_len) * len_ratio
+    counts1 = get_sig_counts(sig1)
+    counts2 = get_sig_counts(sig2)
+    if len(counts1) > len(counts2): # Walk the smaller one
+        counts1, counts2 = counts2, counts1
+    intersection = sum(min(count, counts2.get(element_id, 0)) for element_id, count in counts1.items())
+    return score_intersection(intersection, len(sig1), len(sig2))
+
+@cache_by_id
+def get_inverted_index(proto2sig_map: dict[str, Signature]) -> dict[int, list[tuple[str, int]]]:
+    # Maps every signature element id to the protos containing it (and how many times),
+    # so a signature can be scored against a whole map without intersecting each pair
+    inverted_index: defaultdict[int, list[tuple[str, int]]] = defaultdict(list)
+    for name, sig in proto2sig_map.items():
+        for element_id, count in get_sig_counts(sig).items():
+            inverted_index[element_id].append((name, count))
+    return inverted_index
 
 def get_matches(proto_name: str, match_sig: Signature, proto2sig_map: dict[str, Signature], proto_list: list[str]):
-    threshold = options.getfloat("THRESHOLD", 0.5)
+    # proto2sig_map should only have top-level types (see generate_signatures)
+    threshold = THRESHOLD
     print(f"Scoring Threshold:", colored_percent(threshold))
     score_map: dict[str, float] = {}
-    
+    rank_map: dict[str, float] = {} # Scores weighted by list position, for sorting
+    idx_weights = get_idx_weights(proto_list)
+
+    inverted_index = get_inverted_index(proto2sig_map)
+    intersections: defaultdict[str, int] = defaultdict(int)
+    for element_id, count in get_sig_counts(match_sig).items():
+        for name, other_count in inverted_index.get(element_id, ()):
+            intersections[name] += min(count, other_count)
+
+    match_len = len(match_sig)
     for name, sig in proto2sig_map.items():
-        if "." in name: continue # Skip nested types
-        score = compare_sigs(match_sig, sig)
+        sig_len = len(sig)
+        if get_len_ratio(match_len, sig_len) < threshold: continue # Can't score above it anyway
+        score = score_intersection(intersections[name], match_len, sig_len)
         if score < threshold: continue
         score_map[name] = score
+        rank_map[name] = score + idx_weights[name]
 
     if not score_map:
         return print("No matches found. :cry:")
     
-    def sort_key(tup: tuple[str, float]) -> float:
-        idx_weight = 1 -((proto_list.index(tup[0]) + 1) / len(proto_list))
-        return tup[1] + idx_weight * 0.5
-    
-    matches_sorted = sorted(score_map.items(), key=sort_key, reverse=True)
-    matches_view = matches_sorted[:options.getint("MAX_DISPLAY_MATCHES")]
+    matches_sorted = sorted(rank_map, key=rank_map.__getitem__, reverse=True)
+    matches_view = matches_sorted[:MAX_DISPLAY_MATCHES]
     print(f"Matches for {to_proto_name(proto_name)} (showing {len(matches_view)}/{len(score_map)}):")
-    for name, score in matches_view:
-        place = proto_list.index(name)
-        print(Text.assemble(" " * 3, "(", colored_percent(score), ")"), to_proto_name(name), f"[{place}]")
-
-def generate_signatures(descriptor_set: FileDescriptorSet) -> tuple[
-                        dict[str, Signature], defaultdict[Signature, list[str]]]:
-    descriptor_map: dict[str, FileDescriptorProto] = {}
+    proto_idx = get_index_map(proto_list)
+    for name in matches_view:
+        place = proto_idx[name]
+        print(Text.assemble(" " * 3, "(", colored_percent(score_map[name]), ")"), to_proto_name(name), f"[{place}]")
+
+# Field label/type names as they appear in signatures, e.g. "repeated " and "uint32"
+FIELD_LABELS = {label: (FieldDescriptorProto.Label.Name(label).removeprefix("LABEL_").lower() + " "
+                        if label != FieldDescriptorProto.Label.LABEL_OPTIONAL else "")
+                for label in FieldDescriptorProto.Label.values()}
+FIELD_TYPES = {field_type: FieldDescriptorProto.Type.Name(field_type).removeprefix("TYPE_").lower()
+               for field_type in FieldDescriptorProto.Type.values()}
+
+def sign_protos(descriptor_set: FileDescriptorSet, names: list[str]) -> dict[str, Signature]:
+    # Signs the given top-level types, the returned map also has all of their nested types
+    descriptor_map: dict[str, DescriptorProto | EnumDescriptorProto] = {}
+    signed: dict[str, Signature] = {} # Every type signed so far, including the ones left out of proto2sig_map
     proto2sig_map: dict[str, Signature] = {}
-    sig2proto_map: defaultdict[Signature, list[str]] = defaultdict(list)
 
     for desc in descriptor_set.file:
-        for message in desc.message_type:
-            descriptor_map[message.name] = message
-        for enum in desc.enum_type:
-            descriptor_map[enum.name] = enum
+        pending = [(proto.name, proto) for proto in (*desc.message_type, *desc.enum_type)]
+        while pending:
+            name, proto = pending.pop()
+            descriptor_map[name] = proto
+            if type(proto) == DescriptorProto:
+                pending.extend((f"{name}.{nested.name}", nested) for nested in (*proto.nested_type, *proto.enum_type))
 
     def get_enum_sig(enum: EnumDescriptorProto) -> frozenset:
         if enum.options.allow_alias: return # Ignore CmdId enums
-        return frozenset([e.number for e in enum.value])
+        return intern_sig(frozenset([e.number for e in enum.value]))
 
-    def get_signature(name: str, proto: DescriptorProto | EnumDescriptorProto = None) -> Signature:
+    def get_dependencies(name: str, proto: DescriptorProto | EnumDescriptorProto) -> list[str]:
+        if type(proto) != DescriptorProto:
+            return []
+        return [*(f"{name}.{nested.name}" for nested in (*proto.nested_type, *proto.enum_type)),
+                *(strip_proto_name(field.type_name) for field in proto.field if field.HasField("type_name"))]
+
+    def get_signature(name: str, proto: DescriptorProto | EnumDescriptorProto) -> Signature:
         # The TLDR: For signatures, message and oneof types turn into FrozenMultisets of their fields,
         # enums turn into frozensets of their values, and maps turn into NamedTuples of (key, value)
         # Scalar type fields are just the str of their label and type
         # A field of message, enum, map, or oneof type is a NamedTuple of (label_type, signature)
-        if name in proto2sig_map:
-            return proto2sig_map[name]
-        if not proto:
-            proto = descriptor_map[name]
-           
+        # All the dependencies of the type must already be signed (see sign_type)
         if type(proto) == DescriptorProto:
             field_list: list[str | tuple] = []
             oneofs: list[list[str | tuple]] = [[] for _ in range(len(proto.oneof_decl))]
 
             for nested_type in proto.nested_type:
                 nested_name = f"{name}.{nested_type.name}"
-                proto2sig_map[nested_name] = get_signature(nested_name, nested_type)
+                proto2sig_map[nested_name] = signed[nested_name]
 
             for enum_type in proto.enum_type:
-                if enum_sig := get_enum_sig(enum_type):
-                    nested_name = f"{name}.{enum_type.name}"
+                nested_name = f"{name}.{enum_type.name}"
+                if enum_sig := signed[nested_name]:
                     proto2sig_map[nested_name] = enum_sig
 
             for field in proto.field:
-                field_label = ((FieldDescriptorProto.Label.Name(field.label)
-                                .removeprefix("LABEL_").lower() + " ")
-                                if field.label != FieldDescriptorProto.Label.LABEL_OPTIONAL else "")
-                field_type = FieldDescriptorProto.Type.Name(field.type).removeprefix("TYPE_").lower()
+                field_label = FIELD_LABELS[field.label]
+                field_type = FIELD_TYPES[field.type]
                 field_type_sig: Signature = None
 
                 if field.HasField("type_name"):
-                    type_sig = get_signature(strip_proto_name(field.type_name))
-                    if options.getboolean("DEFAULT_EMPTY_TO_BYTES", True) and not type_sig:
+                    type_sig = signed[strip_proto_name(field.type_name)]
+                    if DEFAULT_EMPTY_TO_BYTES and not type_sig:
                         field_type = "bytes"
                     else:
-                        field_type_sig = get_signature(strip_proto_name(field.type_name))
+                        field_type_sig = type_sig
                         if type(field_type_sig) == MapEntry:
                             field_type = "map"
 
-                field_info = f"{field_label}{field_type}"
+                field_info = intern_sig(f"{field_label}{field_type}")
                 if field_type_sig:
-                    field_info = FieldTuple(field_info, field_type_sig)
+                    field_info = intern_sig(FieldTuple(field_info, field_type_sig))
 
                 if field.HasField("oneof_index"):
                     oneofs[field.oneof_index].append(field_info)
@@ -291,38 +482,130 @@ def generate_signatures(descriptor_set: FileDescriptorSet) -> tuple[
                     field_list.append(field_info)
 
             for olist in oneofs:
-                field_list.append(FieldTuple("oneof", FrozenMultiset(olist)))
+                field_list.append(intern_sig(FieldTuple("oneof", intern_sig(FrozenMultiset(olist)))))
 
             if proto.options.map_entry:
-                return MapEntry(*field_list)
+                return intern_sig(MapEntry(*field_list))
 
-            return FrozenMultiset(field_list)
+            return intern_sig(FrozenMultiset(field_list))
 
         elif type(proto) == EnumDescriptorProto:
             return get_enum_sig(proto)
 
-    for name, proto in descriptor_map.items():
-        sig = get_signature(name, proto)
-        proto2sig_map[name] = sig
-        sig2proto_map[sig].append(name)
-
-    unique_protos = {sig: proto[0] for sig, proto in sig2proto_map.items() if len(proto) == 1}
-    return proto2sig_map, unique_protos
+    def sign_type(name: str):
+        # Post-order DFS with an explicit stack (instead of recursing through get_signature),
+        # so every dependency of a type gets signed before the type itself
+        stack = [(name, False)]
+        in_progress: set[str] = set()
+        while stack:
+            current, deps_signed = stack.pop()
+            if current in signed: continue
+            proto = descriptor_map[current]
+            if deps_signed:
+                signed[current] = get_signature(current, proto)
+                continue
+            if current in in_progress:
+                raise ValueError(f"Can't sign {current}, it depends on itself")
+            in_progress.add(current)
+            stack.append((current, True))
+            stack.extend((dep, False) for dep in get_dependencies(current, proto) if dep not in signed)
+
+    for name in names:
+        sign_type(name)
+        proto2sig_map[name] = signed[name]
+    return proto2sig_map
+
+def init_sign_worker(option_values: dict[str, str]):
+    # Worker processes don't necessarily inherit the loaded config (e.g. on Windows)
+    options.update(option_values)
+    refresh_options()
+
+def sign_protos_worker(serialized_set: bytes, names: list[str]) -> dict[str, Signature]:
+    return sign_protos(FileDescriptorSet.FromString(serialized_set), names)
+
+def generate_signatures(descriptor_set: FileDescriptorSet, workers: int = 1) -> tuple[
+                        dict[str, Signature], dict[Signature, str], dict[str, Signature]]:
+    first_protos: dict[Signature, str] = {} # First proto seen with each signature
+    shared_sigs: set[Signature] = set() # Signatures seen on more than one proto
+    names = list(dict.fromkeys(proto.name for desc in descriptor_set.file
+                               for proto in (*desc.message_type, *desc.enum_type)))
+
+    if workers > 1 and len(names) > workers:
+        # Types from other chunks are looked up in the full descriptor set, so each worker
+        # only re-signs the dependencies it needs. The partial maps get interned bottom-up while
+        # they're unpickled (see unpickle_multiset), so types signed by several workers come back shared.
+        chunk_size = -(-len(names) // workers)
+        chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+        serialized_set = descriptor_set.SerializeToString()
+        proto2sig_map: dict[str, Signature] = {}
+        with ProcessPoolExecutor(workers, initializer=init_sign_worker, initargs=(dict(options),)) as executor:
+            for partial_map in executor.map(sign_protos_worker, repeat(serialized_set), chunks):
+                for name, sig in partial_map.items():
+                    if name not in proto2sig_map:
+                        # Enum frozensets are rebuilt by pickle itself, so those still need interning
+                        proto2sig_map[name] = intern_sig(sig)
+    else:
+        proto2sig_map = sign_protos(descriptor_set, names)
+
+    for name in names:
+        sig = proto2sig_map[name]
+        if sig in first_protos:
+            shared_sigs.add(sig)
+        else:
+            first_protos[sig] = name
+
+    unique_protos = {sig: proto for sig, proto in first_protos.items() if sig not in shared_sigs}
+    top_level_sigs = {name: proto2sig_map[name] for name in names} # Skip nested types
+    return proto2sig_map, unique_protos, top_level_sigs
+
+def load_signatures(descriptor_path: str) -> tuple[
+                    dict[str, Signature], dict[Signature, str], dict[str, Signature]]:
+    # Generated signatures are pickled next to the outputs, and reused for as long as
+    # the descriptor file and the options that affect signature generation stay the same
+    desc_stat = os.stat(descriptor_path)
+    desc_abspath = os.path.abspath(descriptor_path)
+    cache_key = (SIGCACHE_VERSION, desc_abspath, desc_stat.st_mtime_ns, desc_stat.st_size,
+                 PACKAGE_NAME, DEFAULT_EMPTY_TO_BYTES)
+    # The path digest keeps descriptors with the same file name in different folders from sharing a cache
+    path_digest = hashlib.sha1(desc_abspath.encode()).hexdigest()[:8]
+    cache_path = OUTPUT_DIR / f"{Path(descriptor_path).stem}-{path_digest}.sigcache"
+    try:
+        with open(cache_path, "rb") as f:
+            if pickle.load(f) == cache_key:
+                proto2sig_map, unique_protos, top_level_sigs = pickle.load(f)
+                # Nested signatures got interned while unpickling, but enum frozensets are
+                # rebuilt by pickle itself, so the maps still need to go through intern_sig
+                proto2sig_map = {name: intern_sig(sig) for name, sig in proto2sig_map.items()}
+                unique_protos = {intern_sig(sig): name for sig, name in unique_protos.items()}
+                top_level_sigs = {name: intern_sig(sig) for name, sig in top_level_sigs.items()}
+                return proto2sig_map, unique_protos, top_level_sigs
+    except (OSError, EOFError, AttributeError, pickle.UnpicklingError):
+        pass # Missing or unreadable cache, just regenerate it
+
+    workers = options.getint("SIGNATURE_WORKERS", 1) or os.cpu_count()
+    signatures = generate_signatures(get_descriptor_set(descriptor_path), workers)
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    with open(cache_path, "wb") as f:
+        pickle.dump(cache_key, f, protocol=5)
+        pickle.dump(signatures, f, protocol=5)
+    return signatures
 
 def start_sequential_matching(ref_signatures: dict[str, Signature], ref_proto_list: list[str], 
                               obs_signatures: dict[str, Signature], obs_proto_list: list[str], 
                               exact_matches: dict[str, str]):
     seq_matches: dict[str, str] = {}
+    ref_idx = get_index_map(ref_proto_list)
+    obs_idx = get_index_map(obs_proto_list)
     obs_index = 0
     for ref_proto in ref_proto_list:
         if obs_index + 1 >= len(obs_proto_list): break
         if ref_proto not in ref_signatures: continue
 
-        ref_name = f"{to_proto_name(ref_proto)} [{ref_proto_list.index(ref_proto)}]"
+        ref_name = f"{to_proto_name(ref_proto)} [{ref_idx[ref_proto]}]"
         if ref_proto in exact_matches:
             exact_match = exact_matches[ref_proto]
             seq_matches[ref_proto] = exact_match
-            match_name = f"{to_proto_name(exact_match)} [{obs_proto_list.index(exact_match)}]"
+            match_name = f"{to_proto_name(exact_match)} [{obs_idx[exact_match]}]"
             print(f"{ref_name} has an exact unique match with {match_name}!")
             continue
 
@@ -335,7 +618,7 @@ def start_sequential_matching(ref_signatures: dict[str, Signature], ref_proto_li
                 continue
             obs_sig = obs_signatures[obs_proto]
 
-            obs_name = f"{to_proto_name(obs_proto)} [{obs_proto_list.index(obs_proto)}]"
+            obs_name = f"{to_proto_name(obs_proto)} [{obs_idx[obs_proto]}]"
             score = compare_sigs(ref_sig, obs_sig)
             if score == 1:
                 seq_matches[ref_proto] = obs_proto
@@ -357,19 +640,16 @@ def start_sequential_matching(ref_signatures: dict[str, Signature], ref_proto_li
             seq_matches[ref_proto] = obs_proto
             break
     
-    with open(OUTPUT_DIR / "seq_matches.json", "w") as f:
-        json.dump(seq_matches, f, indent=2)
+    save_json(seq_matches, OUTPUT_DIR / "seq_matches.json")
     print("Finished sequential matching.")
 
 def main():
     load_config()
-    ref_descriptor = get_descriptor_set(options["REF_DESCRIPTOR_FILE"])
     ref_proto_list = get_proto_list(options["REF_PROTO_LIST"])
-    obs_descriptor = get_descriptor_set(options["OBS_DESCRIPTOR_FILE"])
     obs_proto_list = get_proto_list(options["OBS_PROTO_LIST"])
 
-    ref_signatures, ref_uniques = generate_signatures(ref_descriptor)
-    obs_signatures, obs_uniques = generate_signatures(obs_descriptor)
+    ref_signatures, ref_uniques, ref_top_level = load_signatures(options["REF_DESCRIPTOR_FILE"])
+    obs_signatures, obs_uniques, obs_top_level = load_signatures(options["OBS_DESCRIPTOR_FILE"])
     exact_matches: dict[str, str] = {}
     perfect_mappables: dict[str, str] = {}
 
@@ -377,9 +657,8 @@ def main():
     perfect_mappables_table = sig_proto_table()
 
     for sig, ref_proto in sorted(ref_uniques.items(), key=lambda x: x[1]):
-        if sig not in obs_uniques:
+        if (obs_proto := obs_uniques.get(sig)) is None:
             continue
-        obs_proto = obs_uniques[sig]
         row = (short_hash(sig), to_proto_name(obs_proto), to_proto_name(ref_proto))
         exact_matches[ref_proto] = obs_proto
         exact_matches_table.add_row(*row)
@@ -405,11 +684,11 @@ def main():
 
             if text in ref_signatures:
                 match_sig = ref_signatures[text]
-                compare_sigs = obs_signatures
+                compare_sigs = obs_top_level
                 proto_list = obs_proto_list
             elif text in obs_signatures:
                 match_sig = obs_signatures[text]
-                compare_sigs = ref_signatures
+                compare_sigs = ref_top_level
                 proto_list = ref_proto_list
             else:
                 print(f"No such proto as {to_proto_name(text)}")
@@ -443,8 +722,7 @@ def main():
         def do_exact_matches(self, _):
             "exact_matches, em\n" \
             "Print a table of exact signature matches."
-            with open(OUTPUT_DIR / "exact_matches.json", "w") as f:
-                json.dump(exact_matches, f, indent=2)
+            save_json(exact_matches, OUTPUT_DIR / "exact_matches.json")
             print(exact_matches_table)
             print(f"Found {len(exact_matches)} unique exact matches from {len(ref_uniques)} "
                   f"unique reference protos ({len(ref_signatures)} total)")
@@ -455,8 +733,7 @@ def main():
             "perfect_mappables, pm\n" \
             "Print a table of protos that are perfectly re-mappable" \
             "(unique exact matches with all unique types)."
-            with open(OUTPUT_DIR / "perfect_mappables.json", "w") as f:
-                json.dump(perfect_mappables, f, indent=2)
+            save_json(perfect_mappables, OUTPUT_DIR / "perfect_mappables.json")
             print(perfect_mappables_table)
             print(f"Found {len(perfect_mappables)} perfectly re-mappable protos "
                   f"from {len(exact_matches)} unique exact matches.")
@@ -467,7 +744,7 @@ def main():
         def do_sequential_match(self, _):
             "sequential_match, sm\n" \
             "Start a sequential matching session using the provided proto lists."
-            start_sequential_matching(ref_signatures, ref_proto_list, obs_signatures, obs_proto_list, exact_matches)
+            start_sequential_matching(ref_top_level, ref_proto_list, obs_top_level, obs_proto_list, exact_matches)
 
         do_sm = do_sequential_match
 